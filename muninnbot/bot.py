@@ -16,7 +16,9 @@
 from enum import Enum
 import asyncio
 import html
-import time
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from attr import dataclass
 
 from maubot import MessageEvent, Plugin
 from maubot.handlers import command, event
@@ -26,12 +28,12 @@ from mautrix.types import (
     EventID,
     EventType,
     Format,
-    MatrixURI,
     Member,
     Membership,
     MessageType,
     ReactionEvent,
     RelationType,
+    RoomID,
     StateEvent,
     TextMessageEventContent,
     UserID,
@@ -39,6 +41,7 @@ from mautrix.types import (
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
 from .namemonitor import NameMonitor
+from .util import BoundedDict, TokenBucket, user_mention_html
 from .wellknown import fetch_support_well_known
 
 
@@ -72,18 +75,56 @@ class JoinType(Enum):
     MEMBER_NOT_LISTED_SUPPORT = "member_not_listed_support"
 
 
+@dataclass(frozen=True)
+class MessageTemplate:
+    html: str
+    plain: str
+
+    @classmethod
+    async def render(cls, template: str) -> "MessageTemplate":
+        # The plaintext version is rendered with the placeholders still in place,
+        # so it can be formatted directly without parsing HTML for every message.
+        plain, _ = await parse_formatted(
+            f"<p>{template}</p>", allow_html=True, render_markdown=False
+        )
+        return cls(html=template, plain=plain)
+
+
+@dataclass(frozen=True)
+class WelcomeMessages:
+    prefix: MessageTemplate
+    recheck_prefix: MessageTemplate
+    suffix: MessageTemplate
+    by_join_type: dict[JoinType, MessageTemplate]
+
+    @classmethod
+    async def from_config(cls, config: Config) -> "WelcomeMessages":
+        return cls(
+            prefix=await MessageTemplate.render(config["messages.prefix"]),
+            recheck_prefix=await MessageTemplate.render(config["messages.recheck_prefix"]),
+            suffix=await MessageTemplate.render(config["messages.suffix"]),
+            by_join_type={
+                jt: await MessageTemplate.render(config[f"messages.{jt.value}"]) for jt in JoinType
+            },
+        )
+
+
 VERIFIED_APPLICATION_SENDER_KEY = "com.muninn-hall.verified_application_sender"
 
 
 class MuninnBot(Plugin):
     space_members: dict[UserID, Member]
-    pending_applications: dict[EventID, UserID | None]
-    welcomed_users: dict[UserID, EventID | None]
+    pending_applications: BoundedDict[EventID, UserID | None]
+    welcomed_users: BoundedDict[UserID, EventID | None]
     welcomed_servers: set[str]
     join_lock: asyncio.Lock
-    join_limiter_count: int
-    join_limiter_ts: float
+    join_limiter: TokenBucket
     name_monitor: NameMonitor
+    well_known_http: ClientSession
+    messages: WelcomeMessages
+    screening_room: RoomID
+    space_room: RoomID
+    application_pings: tuple[UserID, ...]
 
     @classmethod
     def get_config_class(cls) -> type[BaseProxyConfig]:
@@ -91,44 +132,52 @@ class MuninnBot(Plugin):
 
     async def start(self) -> None:
         self.name_monitor = NameMonitor(self)
-        self.on_external_config_update()
+        await self.on_external_config_update()
         await self.name_monitor.start()
         self.register_handler_class(self.name_monitor)
         self.client.add_dispatcher(MembershipEventDispatcher)
-        self.pending_applications = {}
-        self.welcomed_users = {}
+        self.pending_applications = BoundedDict(maxsize=1024)
+        self.welcomed_users = BoundedDict(maxsize=10_000)
         self.space_members = {}
-        self.join_limiter_count = 0
-        self.join_limiter_ts = 0
+        # Allow bursts of 5 welcome messages, then one every 12 seconds
+        self.join_limiter = TokenBucket(capacity=5, refill_interval=12)
         self.join_lock = asyncio.Lock()
-        self.space_members = await self.client.get_joined_members(self.config["space_room"])
+        # Separate session for .well-known lookups so that unresponsive servers time out quickly
+        # and raids from a single server don't open lots of connections to it.
+        self.well_known_http = ClientSession(
+            connector=TCPConnector(limit_per_host=4, ttl_dns_cache=600, keepalive_timeout=60),
+            timeout=ClientTimeout(total=5),
+        )
+        self.space_members = await self.client.get_joined_members(self.space_room)
 
-    def on_external_config_update(self) -> None:
+    async def stop(self) -> None:
+        await self.well_known_http.close()
+
+    async def on_external_config_update(self) -> None:
         self.config.load_and_update()
+        self.screening_room = self.config["screening_room"]
+        self.space_room = self.config["space_room"]
+        self.application_pings = tuple(self.config["application_pings"])
+        self.messages = await WelcomeMessages.from_config(self.config)
         self.name_monitor.read_config()
 
     @event.on(InternalEventType.JOIN)
     async def handle_member(self, evt: StateEvent) -> None:
         if not evt.source & SyncStream.TIMELINE:
             return
-        if evt.room_id == self.config["screening_room"]:
+        if evt.room_id == self.screening_room:
             if (
                 evt.sender in self.space_members
                 or evt.sender == self.client.mxid
                 or evt.sender in self.welcomed_users
             ):
                 return
+            if not self.join_limiter.try_acquire():
+                self.log.warning("Not checking joined member due to rate limiting")
+                return
             async with self.join_lock:
-                if self.join_limiter_ts + 60 < time.monotonic():
-                    self.join_limiter_count = 0
-                elif self.join_limiter_count > 5:
-                    # If more than 5 members join in a minute, stop sending welcome messages
-                    self.log.warning("Not checking joined member due to rate limiting")
-                    return
                 await self._check_member(evt, is_join=True)
-                self.join_limiter_count += 1
-                self.join_limiter_ts = time.monotonic()
-        elif evt.room_id == self.config["space_room"]:
+        elif evt.room_id == self.space_room:
             if evt.content.membership == Membership.JOIN:
                 self.space_members[evt.sender] = Member(
                     membership=evt.content.membership,
@@ -141,12 +190,11 @@ class MuninnBot(Plugin):
     @event.on(InternalEventType.LEAVE)
     @event.on(InternalEventType.BAN)
     async def handle_leave(self, evt: StateEvent) -> None:
-        if evt.room_id == self.config["screening_room"]:
+        if evt.room_id == self.screening_room:
             async with self.join_lock:
-                if evt.sender not in self.welcomed_users:
-                    return
-                evt_id = self.welcomed_users[evt.sender]
-                self.welcomed_users[evt.sender] = None
+                evt_id = self.welcomed_users.get(evt.sender)
+                if evt_id:
+                    self.welcomed_users[evt.sender] = None
             if evt_id:
                 await self.client.redact(evt.room_id, evt_id, reason="User left")
 
@@ -161,14 +209,13 @@ class MuninnBot(Plugin):
 
     async def _make_application_content(self, user_id: UserID) -> TextMessageEventContent:
         content = TextMessageEventContent(msgtype=MessageType.TEXT, format=Format.HTML)
-        content.body, content.formatted_body = await parse_formatted(
-            f'<a href="{MatrixURI.build(user_id).matrix_to_url}">{user_id}</a> '
+        message = (
             "Application received, please wait for manual review. "
-            "Feel free to send messages with additional details if necessary.",
-            allow_html=True,
-            render_markdown=False,
+            "Feel free to send messages with additional details if necessary."
         )
-        content["m.mentions"] = {"user_ids": [user_id, *self.config["application_pings"]]}
+        content.body = f"{user_id} {message}"
+        content.formatted_body = f"{user_mention_html(user_id)} {message}"
+        content["m.mentions"] = {"user_ids": [user_id, *self.application_pings]}
         return content
 
     @event.on(EventType.REACTION)
@@ -206,7 +253,9 @@ class MuninnBot(Plugin):
     async def _check_member(self, evt: StateEvent | MessageEvent, is_join: bool) -> None:
         _, server_name = self.client.parse_user_id(evt.sender)
         try:
-            wk = await fetch_support_well_known(self.http, server_name)
+            wk = await fetch_support_well_known(
+                self.well_known_http, server_name, refresh=not is_join
+            )
             if wk.has_contact(evt.sender):
                 join_type = JoinType.NEW_IS_LISTED_SUPPORT
             else:
@@ -218,26 +267,25 @@ class MuninnBot(Plugin):
             )
             join_type = JoinType.NEW_WELL_KNOWN_MISSING
         # TODO check if the server is already a member
-        user_mention = (
-            f'<a href="{MatrixURI.build(evt.sender).matrix_to_url}">{html.escape(evt.sender)}</a>'
-        )
+        user_mention = user_mention_html(evt.sender)
         server_name_html = html.escape(server_name)
-        if is_join:
-            prefix = self.config["messages.prefix"].format(user=user_mention)
-        else:
-            prefix = self.config["messages.recheck_prefix"].format(user=user_mention)
-        message = self.config[f"messages.{join_type.value}"].format(
-            user=user_mention, server=server_name_html
-        )
-        suffix = self.config["messages.suffix"]
+        messages = self.messages
+        prefix = messages.prefix if is_join else messages.recheck_prefix
+        message = messages.by_join_type[join_type]
+        suffix = messages.suffix
         content = TextMessageEventContent(msgtype=MessageType.NOTICE, format=Format.HTML)
         content["m.mentions"] = {"user_ids": [evt.sender]}
         if join_type == JoinType.NEW_IS_LISTED_SUPPORT:
             content[VERIFIED_APPLICATION_SENDER_KEY] = evt.sender
-        content.body, content.formatted_body = await parse_formatted(
-            f"<p>{prefix}</p><p>{message}</p><p>{suffix}</p>",
-            allow_html=True,
-            render_markdown=False,
+        content.body = (
+            f"{prefix.plain.format(user=evt.sender)}\n\n"
+            f"{message.plain.format(user=evt.sender, server=server_name)}\n\n"
+            f"{suffix.plain}"
+        )
+        content.formatted_body = (
+            f"<p>{prefix.html.format(user=user_mention)}</p>"
+            f"<p>{message.html.format(user=user_mention, server=server_name_html)}</p>"
+            f"<p>{suffix.html}</p>"
         )
         content.set_reply(evt.event_id)
         evt_id = await self.client.send_message(evt.room_id, content)
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import TYPE_CHECKING
+from io import StringIO
+import functools
 import html
 import re
 
@@ -21,66 +23,106 @@ from aiohttp.web import Request, Response, json_response
 
 from maubot import MessageEvent
 from maubot.handlers import command, event, web
-from mautrix.types import EventType, MatrixURI, Membership, MessageType, StateEvent, UserID
+from mautrix.types import (
+    EventType,
+    MatrixURI,
+    Membership,
+    MessageType,
+    RoomID,
+    StateEvent,
+    UserID,
+)
 from mautrix.util import background_task
 
+from .util import user_matrix_url
+
 if TYPE_CHECKING:
     from .bot import MuninnBot
 
 
 bracket_regex = re.compile(r"\[(.+?)]")
-separator_regex = re.compile(r"[, /]")
+# Words are separated by commas, spaces or slashes, and only words containing a dot matter
+dotted_word_regex = re.compile(r"[^, /]*\.[^, /]*")
+
+
+@functools.cache
+def _load_tlds(raw: bytes) -> frozenset[str]:
+    return frozenset(
+        tld.decode("ascii") for tld in raw.lower().splitlines() if tld and not tld.startswith(b"#")
+    )
+
+
+# Displaynames rarely change, but membership events are sent for every avatar change too
+@functools.lru_cache(maxsize=2048)
+def _parse_name(name: str, tlds: frozenset[str]) -> frozenset[str]:
+    output = set()
+    for chunk in bracket_regex.findall(name.lower()):
+        for word in dotted_word_regex.findall(chunk):
+            domain, _, tld = word.rpartition(".")
+            if domain and tld in tlds:
+                output.add(word)
+    return frozenset(output)
 
 
 class NameMonitor:
     bot: "MuninnBot"
-    tlds: set[str]
+    tlds: frozenset[str]
     member_names: dict[UserID, str]
-    mxid_to_servers: dict[UserID, set[str]]
+    mxid_to_servers: dict[UserID, frozenset[str]]
     server_to_mxids: dict[str, set[UserID]]
-    excluded_members: set[UserID]
+    users_without_server: set[UserID]
+    excluded_members: frozenset[UserID]
+    main_room: RoomID
 
     def __init__(self, bot: "MuninnBot") -> None:
         self.bot = bot
-        self.tlds = set()
+        self.tlds = frozenset()
         self.member_names = {}
         self.mxid_to_servers = {}
         self.server_to_mxids = {}
+        self.users_without_server = set()
 
     def read_config(self) -> None:
-        self.excluded_members = set(self.bot.config["excluded_members"])
+        self.excluded_members = frozenset(self.bot.config["excluded_members"])
+        self.main_room = self.bot.config["main_room"]
 
     async def start(self) -> None:
-        self.tlds = {
-            tld.decode("utf-8").lower()
-            for tld in (await self.bot.loader.read_file("tlds-alpha-by-domain.txt")).split(b"\n")
-            if tld and not tld.startswith(b"#")
-        }
+        self.tlds = _load_tlds(await self.bot.loader.read_file("tlds-alpha-by-domain.txt"))
         background_task.create(self.load_members())
 
     async def load_members(self) -> None:
-        members = await self.bot.client.get_joined_members(self.bot.config["main_room"])
+        members = await self.bot.client.get_joined_members(self.main_room)
+        excluded_members = self.excluded_members
+        member_names = self.member_names
+        parse_name = self.parse_name
+        update_member = self._update_member
         for user_id, member in members.items():
-            if user_id in self.excluded_members:
+            if user_id in excluded_members:
                 continue
-            self.member_names[user_id] = member.displayname or user_id
-            self._update_member(user_id, self.parse_name(member.displayname))
+            member_names[user_id] = member.displayname or user_id
+            update_member(user_id, parse_name(member.displayname))
 
     @command.new("member-directory")
     async def get_member_directory(self, evt: MessageEvent) -> None:
+        buf = StringIO()
+        write = buf.write
+        write("<details><summary>Member Directory</summary><ul>")
+        for user_id, servers in self.mxid_to_servers.items():
+            write("<li><a href='")
+            write(user_matrix_url(user_id))
+            write("'>")
+            write(self.member_names[user_id])
+            write("</a>: ")
+            if servers:
+                write("<code>")
+                write("</code>, <code>".join(servers))
+                write("</code>")
+            else:
+                write("<em>none found</em>")
+            write("</li>")
+        write("</ul></details>")
         await evt.reply(
-            "<details><summary>Member Directory</summary><ul>"
-            + "".join(
-                f"<li><a href='{MatrixURI.build(user_id).matrix_to_url}'>{self.member_names[user_id]}</a>: "
-                + (
-                    f"<code>{"</code>, <code>".join(servers)}</code>"
-                    if servers
-                    else "<em>none found</em>"
-                )
-                + "</li>"
-                for user_id, servers in self.mxid_to_servers.items()
-            )
-            + "</ul></details>",
+            buf.getvalue(),
             extra_content={
                 "body": "Member Directory - plaintext body not available",
                 "m.mentions": {},
@@ -110,17 +152,13 @@ class NameMonitor:
 
     @command.new("ping-users-without-server-in-name")
     async def ping_users_without_server_in_name(self, evt: MessageEvent) -> None:
-        user_ids = []
-        htmls = []
-        for user_id, servers in self.mxid_to_servers.items():
-            if servers:
-                continue
-            user_ids.append(user_id)
-            htmls.append(
-                f'<a href="{MatrixURI.build(user_id).matrix_to_url}">'
-                f"{html.escape(self.member_names[user_id])}"
-                "</a>"
-            )
+        user_ids = list(self.users_without_server)
+        htmls = [
+            f'<a href="{user_matrix_url(user_id)}">'
+            f"{html.escape(self.member_names[user_id])}"
+            "</a>"
+            for user_id in user_ids
+        ]
         if not user_ids:
             await evt.react("✅️")
             return
@@ -139,7 +177,7 @@ class NameMonitor:
 
     @event.on(EventType.ROOM_MEMBER)
     async def handle_member(self, evt: StateEvent) -> None:
-        if evt.room_id != self.bot.config["main_room"]:
+        if evt.room_id != self.main_room:
             return
         user_id = UserID(evt.state_key)
         if user_id in self.excluded_members:
@@ -147,25 +185,25 @@ class NameMonitor:
         if evt.content.membership != Membership.JOIN:
             self._remove_member(user_id)
             return
-        self.member_names[user_id] = evt.content.displayname or user_id
+        name = evt.content.displayname or user_id
+        if self.member_names.get(user_id) == name:
+            # Avatar changes also send membership events, no need to reparse the name for those
+            return
+        self.member_names[user_id] = name
         self._update_member(user_id, self.parse_name(evt.content.displayname))
 
-    def parse_name(self, name: str) -> set[str]:
-        output = set()
-        for chunk in bracket_regex.finditer(name or ""):
-            for word in separator_regex.split(chunk.group(1)):
-                if "." not in word:
-                    continue
-                word = word.lower()
-                domain, tld = word.rsplit(".", 1)
-                if not domain or tld not in self.tlds:
-                    continue
-                output.add(word)
-        return output
+    def parse_name(self, name: str | None) -> frozenset[str]:
+        if not name or "[" not in name:
+            return frozenset()
+        return _parse_name(name, self.tlds)
 
-    def _update_member(self, user_id: UserID, new_servers: set[str]) -> None:
-        old_servers = self.mxid_to_servers.get(user_id, set())
+    def _update_member(self, user_id: UserID, new_servers: frozenset[str]) -> None:
+        old_servers = self.mxid_to_servers.get(user_id, frozenset())
         self.mxid_to_servers[user_id] = new_servers
+        if new_servers:
+            self.users_without_server.discard(user_id)
+        else:
+            self.users_without_server.add(user_id)
         if new_servers == old_servers:
             return
         for server in old_servers - new_servers:
@@ -174,7 +212,9 @@ class NameMonitor:
             self._add_member_to_server(server, user_id)
 
     def _remove_member(self, user_id: UserID) -> None:
-        servers = self.mxid_to_servers.pop(user_id, set())
+        self.member_names.pop(user_id, None)
+        servers = self.mxid_to_servers.pop(user_id, frozenset())
+        self.users_without_server.discard(user_id)
         for server in servers:
             self._remove_member_from_server(server, user_id)
 
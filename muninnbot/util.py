@@ -0,0 +1,87 @@
+# muninnbot - A welcome bot for Muninn Hall
+# Copyright (C) 2025 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import TypeVar
+from collections import OrderedDict
+import functools
+import html
+import time
+
+from mautrix.types import MatrixURI, UserID
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+@functools.lru_cache(maxsize=4096)
+def user_matrix_url(user_id: UserID) -> str:
+    """Get the matrix.to URL for the given user ID."""
+    return MatrixURI.build(user_id).matrix_to_url
+
+
+@functools.lru_cache(maxsize=4096)
+def user_mention_html(user_id: UserID) -> str:
+    """Get an HTML link to the given user ID, which clients render as a mention pill."""
+    return f'<a href="{user_matrix_url(user_id)}">{html.escape(user_id)}</a>'
+
+
+class BoundedDict(OrderedDict[K, V]):
+    """A dict that drops the least recently set items once it grows past ``maxsize``."""
+
+    maxsize: int
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key: K, value: V) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class TokenBucket:
+    """
+    A rate limiter that allows bursts of up to ``capacity`` actions and refills one token every
+    ``refill_interval`` seconds.
+    """
+
+    capacity: int
+    refill_interval: float
+    _tokens: float
+    _updated_at: float
+
+    def __init__(self, capacity: int, refill_interval: float) -> None:
+        self.capacity = capacity
+        self.refill_interval = refill_interval
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    def try_acquire(self) -> bool:
+        """
+        Take a token from the bucket if one is available.
+
+        Returns:
+            True if a token was taken, False if the action should be rate limited.
+        """
+        now = time.monotonic()
+        refilled = self._tokens + (now - self._updated_at) / self.refill_interval
+        self._tokens = min(self.capacity, refilled)
+        self._updated_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
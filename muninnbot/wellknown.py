@@ -13,11 +13,19 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import time
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
 from aiohttp import ClientSession
 from attr import dataclass
 import attr
 
-from mautrix.types import ExtensibleEnum, SerializableAttrs, UserID
+from mautrix.types import ExtensibleEnum, SerializableAttrs, UserID, field
 
 
 class SupportRole(ExtensibleEnum):
@@ -25,17 +33,23 @@ class SupportRole(ExtensibleEnum):
     SECURITY = "m.role.security"
 
 
-@dataclass
+@dataclass(slots=True)
 class SupportContact(SerializableAttrs):
     role: SupportRole
     email_address: str = ""
     matrix_id: UserID = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class SupportWellKnown(SerializableAttrs):
     contacts: list[SupportContact] = attr.ib(factory=list)
     support_page: str = ""
+    _matrix_ids: frozenset[UserID] = field(hidden=True, init=False, repr=False, eq=False)
+
+    def __attrs_post_init__(self) -> None:
+        self._matrix_ids = frozenset(
+            contact.matrix_id for contact in self.contacts if contact.matrix_id
+        )
 
     def has_contact(self, user_id: UserID) -> bool:
         """
@@ -47,21 +61,81 @@ class SupportWellKnown(SerializableAttrs):
         Returns:
             True if a contact exists for the user ID, False otherwise.
         """
-        return any(contact.matrix_id == user_id for contact in self.contacts)
+        return user_id in self._matrix_ids
+
+
+WellKnownCache = dict[str, tuple[float, SupportWellKnown | Exception]]
+
+CACHE_TTL = 60 * 60
+NEGATIVE_CACHE_TTL = 5 * 60
+
+_default_cache: WellKnownCache = {}
+_pending_fetches: dict[str, asyncio.Task[SupportWellKnown]] = {}
 
 
-async def fetch_support_well_known(sess: ClientSession, server_name: str) -> SupportWellKnown:
+def _get_cached(cache: WellKnownCache, server_name: str) -> SupportWellKnown | None:
+    try:
+        expiry, result = cache[server_name]
+    except KeyError:
+        return None
+    if expiry < time.monotonic():
+        del cache[server_name]
+        return None
+    if isinstance(result, Exception):
+        raise result.with_traceback(None)
+    return result
+
+
+async def fetch_support_well_known(
+    sess: ClientSession,
+    server_name: str,
+    *,
+    cache: WellKnownCache = _default_cache,
+    refresh: bool = False,
+) -> SupportWellKnown:
     """
     Fetch the support well-known record for a given server name.
 
+    Successful responses are cached for an hour and failures for five minutes. Concurrent calls
+    for the same server name share a single request.
+
     Args:
         sess: The aiohttp ClientSession to use for the request.
         server_name: The server name to fetch the support well-known record for.
+        cache: The cache to store results in.
+        refresh: If True, ignore any cached result and always make a new request.
 
     Returns:
         A SupportWellKnown object containing the support contacts and support page.
     """
+    if refresh:
+        cache.pop(server_name, None)
+    cached = _get_cached(cache, server_name)
+    if cached is not None:
+        return cached
+    task = _pending_fetches.get(server_name)
+    if task is None:
+        task = asyncio.create_task(_fetch_and_cache(sess, server_name, cache))
+        _pending_fetches[server_name] = task
+        task.add_done_callback(lambda _: _pending_fetches.pop(server_name, None))
+    # The fetch is shared, so cancelling one caller mustn't cancel it for the others
+    return await asyncio.shield(task)
+
+
+async def _fetch_and_cache(
+    sess: ClientSession, server_name: str, cache: WellKnownCache
+) -> SupportWellKnown:
+    try:
+        result = await _fetch_support_well_known(sess, server_name)
+    except Exception as e:
+        cache[server_name] = (time.monotonic() + NEGATIVE_CACHE_TTL, e)
+        raise
+    cache[server_name] = (time.monotonic() + CACHE_TTL, result)
+    return result
+
+
+async def _fetch_support_well_known(sess: ClientSession, server_name: str) -> SupportWellKnown:
     url = f"https://{server_name}/.well-known/matrix/support"
     async with sess.get(url) as resp:
         resp.raise_for_status()
-        return SupportWellKnown.deserialize(await resp.json(content_type=None))
+        return SupportWellKnown.deserialize(json.loads(await resp.read()))